@@ -3,70 +3,217 @@
 
 import csv
 import logging
+import mmap
+import os
 import sys
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from pathlib import Path
 
 import orjson
 
-from config import settings
+from config import configure_logging, settings
 
 logger = logging.getLogger(__name__)
 
+# Outputs are machine-consumed, pretty-print only when debugging
+_INDENT = orjson.OPT_INDENT_2 if settings.log_level == "DEBUG" else 0
 
-def aggregate_geojson_files() -> tuple[dict, list[dict]]:
-    geojson_files = list(settings.input_dir.glob("*_vehicles.geojson"))
+# Layout written by the geo converter: header line ending in the features opening, then one Feature per line
+FEATURES_OPENING = b',"features":[\n'
+FEATURES_CLOSING = b"]}"
+FEATURE_PREFIX = b'{"type":"Feature",'
+
+# Per-parking NDJSON shards written by the geo converter, one compact Feature per line
+SHARD_SUFFIX = "_features.ndjson"
+
+
+def splice_features(mm: mmap.mmap) -> tuple[dict, list[bytes]] | None:
+    """Copy the feature lines out of a geo converter GeoJSON without parsing them.
+
+    Only the small header line is parsed. Each remaining line must look like a compact Feature and their
+    count must match the header's total_vehicles; anything else (pretty-printed, hand-written, truncated)
+    returns None so the caller falls back to a full parse.
+    """
+    header = mm.readline()
+    if not header.endswith(FEATURES_OPENING):
+        return None
     
-    if not geojson_files:
-        logger.warning(f"No *_vehicles.geojson files found in {settings.input_dir}")
-        geojson_files = list(settings.input_dir.glob("*.geojson"))
+    try:
+        properties = orjson.loads(header[:-1] + FEATURES_CLOSING).get("properties") or {}
+    except orjson.JSONDecodeError:
+        return None
     
-    logger.info(f"Found [bold]{len(geojson_files)}[/] GeoJSON files to aggregate")
+    body = mm[mm.tell():]
+    if not body.endswith(FEATURES_CLOSING):
+        return None
     
-    all_features = []
-    parking_stats = []
+    # Compact JSON never contains a raw newline, so each line is exactly one array element
+    lines = body[:-len(FEATURES_CLOSING) - 1].split(b",\n") if body != FEATURES_CLOSING else []
     
-    for geojson_path in sorted(geojson_files):
-        logger.debug(f"Processing: {geojson_path.name}")
-        
-        with open(geojson_path, "rb") as f:
-            data = orjson.loads(f.read())
+    if len(lines) != properties.get("total_vehicles"):
+        return None
+    if not all(line.startswith(FEATURE_PREFIX) and line.endswith(b"}") for line in lines):
+        return None
+    
+    return properties, lines
+
+
+def load_geojson(geojson_path: Path) -> tuple[str, list[bytes]]:
+    """Load a GeoJSON file and return its parking name and compact-serialized features."""
+    # Read-only memory map, no f.read() copy; start readahead now since orjson holds the GIL while it faults pages in
+    with open(geojson_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.madvise(mmap.MADV_WILLNEED)
+        spliced = splice_features(mm)
         
-        parking_name = data.get("properties", {}).get("parking") or geojson_path.stem.replace("_vehicles", "")
-        features = data.get("features", [])
+        if spliced is not None:
+            properties, lines = spliced
+        else:
+            logger.debug(f"Parsing {geojson_path.name} (not in the geo converter layout)")
+            with memoryview(mm) as view:
+                data = orjson.loads(view)
+            properties = data.get("properties", {})
+            lines = [orjson.dumps(feature) for feature in data.get("features", [])]
+    
+    parking_name = properties.get("parking") or geojson_path.stem.replace("_vehicles", "")
+    return parking_name, lines
+
+
+def load_shard(shard_path: Path) -> tuple[str, list[bytes]]:
+    """Load a per-parking NDJSON shard and return its parking name and feature lines.
+
+    Lines are copied as-is, without parsing. Like splice_features, every line must look like a compact Feature,
+    which catches a shard that was truncated or interleaved mid-write or is not in the geo converter layout.
+    """
+    lines = shard_path.read_bytes().splitlines()
+    
+    if not all(line.startswith(FEATURE_PREFIX) and line.endswith(b"}}") for line in lines):
+        raise ValueError(f"{shard_path.name} is not a geo converter features shard")
+    
+    return shard_path.name.removesuffix(SHARD_SUFFIX), lines
+
+
+def load_input(path: Path) -> tuple[str, list[bytes]]:
+    """Load an NDJSON shard or a GeoJSON file, whichever the path is."""
+    if path.name.endswith(SHARD_SUFFIX):
+        return load_shard(path)
+    return load_geojson(path)
+
+
+def iter_input_files(paths: list[Path]) -> Iterator[tuple[str, list[bytes]]]:
+    """Load input files concurrently, yielding in input order with at most read_workers files in flight."""
+    with ThreadPoolExecutor(max_workers=settings.read_workers) as executor:
+        pending = deque()
         
-        all_features.extend(features)
-        parking_stats.append({"parking": parking_name, "vehicles": len(features)})
+        for path in paths:
+            pending.append(executor.submit(load_input, path))
+            if len(pending) >= settings.read_workers:
+                yield pending.popleft().result()
         
-        logger.info(f"  {parking_name}: [bold]{len(features)}[/] vehicles")
+        while pending:
+            yield pending.popleft().result()
+
+
+def find_input_files() -> list[Path]:
+    """Find the files to aggregate in a single directory pass.
+
+    Per-parking *_features.ndjson shards are preferred; they hold the same features as the per-tile
+    *_vehicles.geojson files, which are used otherwise (or any *.geojson as a last resort).
+    """
+    shard_files = []
+    vehicles_files = []
+    other_files = []
+    
+    # DirEntry caches the file type from readdir, so no extra stat per entry
+    with os.scandir(settings.input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(SHARD_SUFFIX) and entry.is_file():
+                shard_files.append(Path(entry.path))
+            elif not entry.name.endswith(".geojson") or not entry.is_file():
+                continue
+            elif entry.name.endswith("_vehicles.geojson"):
+                vehicles_files.append(Path(entry.path))
+            else:
+                other_files.append(Path(entry.path))
+    
+    if shard_files:
+        return shard_files
+    
+    if not vehicles_files:
+        logger.warning(f"No *_vehicles.geojson files found in {settings.input_dir}")
+        return other_files
+    
+    return vehicles_files
+
+
+def aggregate_geojson_files(output_path: Path, ndjson_path: Path, generated_at: datetime) -> tuple[dict, list[dict]]:
+    """Stream features from all input files into one FeatureCollection, with at most read_workers files in memory.
+
+    Every feature is also written to a newline-delimited companion file so consumers can stream it line by line.
+    """
+    input_files = find_input_files()
+    
+    logger.info(f"Found [bold]{len(input_files)}[/] files to aggregate")
+    
+    # Keyed by parking, so per-tile fallback files add up to one entry per parking, like the shards
+    vehicle_counts = {}
+    total_vehicles = 0
     
-    combined = {
-        "type": "FeatureCollection",
-        "properties": {
+    with open(output_path, "wb") as out, open(ndjson_path, "wb") as ndjson:
+        out.write(b'{"type":"FeatureCollection","features":[')
+        separator = b""
+        
+        for parking_name, lines in iter_input_files(sorted(input_files)):
+            if lines:
+                # The same compact bytes feed both outputs (NDJSON lines must stay compact)
+                ndjson.write(b"\n".join(lines))
+                ndjson.write(b"\n")
+                
+                out.write(separator)
+                if _INDENT:
+                    out.write(b",".join([orjson.dumps(orjson.loads(line), option=_INDENT) for line in lines]))
+                else:
+                    out.write(b",".join(lines))
+                separator = b","
+            
+            total_vehicles += len(lines)
+            vehicle_counts[parking_name] = vehicle_counts.get(parking_name, 0) + len(lines)
+        
+        parking_stats = [{"parking": name, "vehicles": count} for name, count in vehicle_counts.items()]
+        for stat in parking_stats:
+            logger.info(f"  {stat['parking']}: [bold]{stat['vehicles']}[/] vehicles")
+        
+        # Totals are only known once every file has been streamed, so properties trail the features
+        properties = {
             "total_parkings": len(parking_stats),
-            "total_vehicles": len(all_features),
-            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "total_vehicles": total_vehicles,
+            "generated_at": generated_at.isoformat(),
             "crs": "EPSG:4326",
-        },
-        "features": all_features,
-    }
+        }
+        out.write(b'],"properties":')
+        out.write(orjson.dumps(properties, option=_INDENT))
+        out.write(b"}")
     
-    return combined, parking_stats
+    return properties, parking_stats
 
 
-def save_stats_csv(stats: list[dict]) -> None:
-    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+def save_stats_csv(stats: list[dict], generated_at: datetime) -> None:
+    timestamp = generated_at.strftime("%Y-%m-%dT%H:%M:%S")
     csv_path = settings.output_dir / "stats.csv"
     
-    with open(csv_path, "w", newline="") as f:
+    with open(csv_path, "w", newline="", buffering=1 << 20) as f:
         writer = csv.writer(f)
         writer.writerow(["parking", "vehicles", "timestamp"])
-        for stat in stats:
-            writer.writerow([stat["parking"], stat["vehicles"], timestamp])
+        writer.writerows([(stat["parking"], stat["vehicles"], timestamp) for stat in stats])
     
     logger.info(f"Saved stats CSV: {csv_path}")
 
 
 def main():
+    configure_logging(settings.log_level, settings.logging_plain)
+    
     if not settings.input_dir.exists():
         logger.error(f"Input directory not found: {settings.input_dir}")
         sys.exit(1)
@@ -74,19 +221,21 @@ def main():
     settings.output_dir.mkdir(parents=True, exist_ok=True)
     
     try:
-        combined_geojson, parking_stats = aggregate_geojson_files()
+        # One timestamp for the whole run, shared by the GeoJSON properties and every CSV row
+        generated_at = datetime.now(timezone.utc)
         
         geojson_path = settings.output_dir / "all_parkings.geojson"
-        with open(geojson_path, "wb") as f:
-            f.write(orjson.dumps(combined_geojson, option=orjson.OPT_INDENT_2))
+        ndjson_path = settings.output_dir / "all_parkings.ndgeojson"
+        properties, parking_stats = aggregate_geojson_files(geojson_path, ndjson_path, generated_at)
         logger.info(f"Saved combined GeoJSON: {geojson_path}")
+        logger.info(f"Saved newline-delimited GeoJSON: {ndjson_path}")
         
-        save_stats_csv(parking_stats)
+        save_stats_csv(parking_stats, generated_at)
         
         logger.info("")
         logger.info("[bold green]AGGREGATION COMPLETE[/]")
         logger.info(f"Total parkings: [bold]{len(parking_stats)}[/]")
-        logger.info(f"Total vehicles: [bold]{combined_geojson['properties']['total_vehicles']}[/]")
+        logger.info(f"Total vehicles: [bold]{properties['total_vehicles']}[/]")
         
     except Exception as e:
         logger.error(f"Error: {e}")
@@ -1,11 +1,13 @@
 """Configuration for Geo Converter."""
 
 import logging.config
+import re
+import sys
 from pathlib import Path
 from typing import Literal
 
+from pydantic import Field
 from pydantic_settings import BaseSettings
-from rich.console import Console
 
 
 class Settings(BaseSettings):
@@ -14,10 +16,45 @@ class Settings(BaseSettings):
     tiles_dir: Path = Path("/data/output/parking")
     detections_dir: Path = Path("/data/output")
     output_dir: Path = Path("/data/output")
+    # Pods run under a fractional CPU limit, so converting in-process is the default; raise with the CPU limit
+    max_workers: int = Field(default=1, ge=1)
     log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "INFO"
+    logging_plain: bool = False
 
 
-def configure_logging(log_level: str = "INFO") -> None:
+class PlainFormatter(logging.Formatter):
+    """Formatter for plain log lines that drops the Rich markup tags ([bold], [/], ...) used in messages."""
+
+    markup = re.compile(r"\[(?:/|/?[a-z][a-z_ ]*)\]")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return self.markup.sub("", super().formatMessage(record))
+
+
+def configure_logging(log_level: str = "INFO", plain: bool = False) -> None:
+    """Configure logging; called from main() so importing the module stays cheap.
+
+    Rich is only used on an interactive terminal: pod logs are scraped as plain text, so there it would only add
+    import time and per-record rendering.
+    """
+    if plain or not sys.stderr.isatty():
+        # Plain stderr lines: skips importing Rich and rendering markup on every record
+        handler = {
+            "formatter": "plain",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stderr",
+        }
+    else:
+        from rich.console import Console
+
+        handler = {
+            "formatter": "default",
+            "class": "rich.logging.RichHandler",
+            "console": Console(stderr=True),
+            "omit_repeated_times": False,
+            "markup": True,
+        }
+
     logging.config.dictConfig({
         "version": 1,
         "disable_existing_loggers": False,
@@ -26,15 +63,14 @@ def configure_logging(log_level: str = "INFO") -> None:
                 "format": "[dark_cyan]%(name)s[/] %(message)s",
                 "datefmt": "%Y-%m-%d %H:%M:%S",
             },
+            "plain": {
+                "()": PlainFormatter,
+                "format": "%(asctime)s %(levelname)s %(name)s %(message)s",
+                "datefmt": "%Y-%m-%d %H:%M:%S",
+            },
         },
         "handlers": {
-            "default": {
-                "formatter": "default",
-                "class": "rich.logging.RichHandler",
-                "console": Console(stderr=True),
-                "omit_repeated_times": False,
-                "markup": True,
-            },
+            "default": handler,
         },
         "loggers": {
             "root": {"handlers": ["default"], "level": log_level},
@@ -43,4 +79,3 @@ def configure_logging(log_level: str = "INFO") -> None:
 
 
 settings = Settings()
-configure_logging(settings.log_level)
@@ -3,145 +3,218 @@
 
 import logging
 import math
+import mmap
 import sys
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any
 
+import numpy as np
 import orjson
 
-from config import settings
+from config import configure_logging, settings
 
 logger = logging.getLogger(__name__)
 
+# Outputs are machine-consumed, pretty-print only when debugging
+_INDENT = orjson.OPT_INDENT_2 if settings.log_level == "DEBUG" else 0
+
 # Web Mercator origin (half of world extent in meters)
 ORIGIN = 20037508.342787
 
+# Inverse Web Mercator constants, hoisted out of the per-vertex math
+_LON_K = 180.0 / ORIGIN
+_MERC_K = math.pi / ORIGIN
+_LAT_K = 360.0 / math.pi
+
+# Fewest tiles worth handing to each extra worker process
+MIN_TILES_PER_WORKER = 50
+
+
+def load_json(path: Path) -> Any:
+    """Parse a JSON file straight from a read-only memory map, without copying it into a bytes object."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        return orjson.loads(view)
+
 
-def epsg3857_to_epsg4326(x: float, y: float) -> tuple[float, float]:
-    """Convert EPSG:3857 (Web Mercator meters) to EPSG:4326 (WGS84 degrees)."""
-    lon = x * 180 / ORIGIN
-    lat = math.atan(math.exp(y * math.pi / ORIGIN)) * 360 / math.pi - 90
+def epsg3857_to_epsg4326(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Convert EPSG:3857 (Web Mercator meters) to EPSG:4326 (WGS84 degrees).
+
+    Deliberately hand-rolled instead of using a pyproj Transformer: on batched arrays the closed-form
+    spherical inverse is ~10x faster than Transformer.transform and reproduces the previous output bit for bit.
+    """
+    lon = x * _LON_K
+    lat = np.arctan(np.exp(y * _MERC_K)) * _LAT_K - 90
     return lon, lat
 
 
-def pixel_polygon_to_lonlat_polygon(polygon_pixel: list[list[float]], image_size: list[int], bbox_3857: list[float]) -> list[list[list[float]]]:
-    """Convert OBB pixel polygon to GeoJSON Polygon coordinates in EPSG:4326."""
+def make_converter(image_size: list[int], bbox_3857: list[float]) -> Callable[[np.ndarray], np.ndarray]:
+    """Build a converter of (N, K, 2) OBB pixel polygons to closed (N, K+1, 2) lon/lat rings for one tile.
+
+    The tile's pixel -> EPSG:3857 affine is resolved once here and bound as closure locals, so converting all
+    polygons of the tile is a single vectorized call.
+    """
     width, height = image_size
     min_x, min_y, max_x, max_y = bbox_3857
-
     x_scale = (max_x - min_x) / width
     y_scale = (max_y - min_y) / height
 
-    coords = []
-    for px, py in polygon_pixel:
+    def convert(polygons_pixel: np.ndarray) -> np.ndarray:
         # Convert pixel to EPSG:3857
-        x = min_x + px * x_scale
-        y = max_y - py * y_scale  # y is inverted: pixel 0 = max_y
+        x = min_x + polygons_pixel[..., 0] * x_scale
+        y = max_y - polygons_pixel[..., 1] * y_scale  # y is inverted: pixel 0 = max_y
 
         # Convert EPSG:3857 to EPSG:4326
-        lon, lat = epsg3857_to_epsg4326(x, y)
-        coords.append([round(lon, 7), round(lat, 7)])
+        coords = np.stack(epsg3857_to_epsg4326(x, y), axis=-1)
+        np.round(coords, 7, out=coords)
+
+        # Close the polygon rings
+        return np.concatenate([coords, coords[:, :1]], axis=1)
+
+    return convert
+
+
+def convert_tile_detections(tile: dict, detections: list[dict]) -> dict:
+    """Convert a tiles.json entry's detections to compact, serialized GeoJSON features."""
+    tile_id = tile["tile_id"]
+    parking_name = tile["parking"]
+
+    if not detections:
+        return {"tile_id": tile_id, "features": []}
+
+    convert = make_converter(tile["image_size"], tile["bbox"])
+    # float64 on purpose: float32 meters are off by up to ~0.17 m at Polish Mercator coordinates, which changes
+    # the 7th decimal of ~95% of longitudes; even float32 pixels alone flip some outputs
+    polygons_pixel = np.asarray([det["polygon_pixel"] for det in detections], dtype=np.float64)
+    polygons = convert(polygons_pixel)
+
+    # Only class, confidence and geometry vary per detection, so the rest of the Feature is serialized once per tile
+    tile_properties = b',"parking":' + orjson.dumps(parking_name) + b',"tile_id":' + orjson.dumps(tile_id)
+    feature_template = (
+        b'{"type":"Feature","properties":{"class":%b,"confidence":%b' + tile_properties.replace(b"%", b"%%")
+        + b'},"geometry":{"type":"Polygon","coordinates":[%b]}}'
+    )
+
+    features = [
+        feature_template % (
+            orjson.dumps(det["class_name"]),
+            orjson.dumps(det["confidence"]),
+            # Rings stay float64 ndarrays all the way into the serializer
+            orjson.dumps(polygon, option=orjson.OPT_SERIALIZE_NUMPY),
+        )
+        for det, polygon in zip(detections, polygons)
+    ]
 
-    # Close the polygon ring
-    coords.append(coords[0])
+    return {
+        "tile_id": tile_id,
+        "features": features,
+    }
 
-    return [coords]
 
+def convert_and_save_tile(tile: dict, detections: list[dict]) -> tuple[int, bytes]:
+    """Convert a single tile and write its GeoJSON.
 
-def convert_tile_detections(tile_id: str, parking_name: str) -> dict | None:
-    """Convert detections for a single tile to GeoJSON features."""
-    tile_name = f"{parking_name}_{tile_id}"
-    detections_path = settings.detections_dir / f"{tile_name}_detections.json"
-    meta_path = settings.tiles_dir / f"tile_{tile_id}_meta.json"
+    Returns the number of vehicles and the tile's features as newline-delimited bytes for the parking's NDJSON shard.
+    """
+    result = convert_tile_detections(tile, detections)
+    features = result["features"]
 
-    if not detections_path.exists():
-        logger.debug(f"No detections file for tile {tile_id}, skipping")
-        return None
+    tile_name = f"{tile['parking']}_{tile['tile_id']}"
+    properties = {
+        "parking": tile["parking"],
+        "tile_id": tile["tile_id"],
+        "total_vehicles": len(features),
+        "crs": "EPSG:4326",
+    }
+
+    if _INDENT:
+        payload = orjson.dumps({
+            "type": "FeatureCollection",
+            "properties": properties,
+            "features": [orjson.Fragment(feature) for feature in features],
+        }, option=_INDENT)
+    else:
+        # Header on the first line, then one compact Feature per line: the aggregator splices these lines
+        # into its outputs without parsing them again
+        payload = b"".join([
+            b'{"type":"FeatureCollection","properties":', orjson.dumps(properties), b',"features":[\n',
+            b",\n".join(features), b"\n]}" if features else b"]}",
+        ])
+
+    # Whole file assembled in memory: one open, one write, one close per tile
+    (settings.output_dir / f"{tile_name}_vehicles.geojson").write_bytes(payload)
 
-    if not meta_path.exists():
-        logger.warning(f"Meta file not found for tile {tile_id}: {meta_path}")
-        return None
+    return len(features), b"".join([feature + b"\n" for feature in features])
+
+
+def load_detections(detections_path: Path) -> dict[str, list[dict]]:
+    """Read a parking's detections NDJSON line by line, mapping each tile_id to its detections."""
+    detections = {}
 
     with open(detections_path, "rb") as f:
-        detections_data = orjson.loads(f.read())
-
-    with open(meta_path, "rb") as f:
-        meta = orjson.loads(f.read())
-
-    image_size = meta["image_size"]
-    bbox = meta["bbox"]
-
-    features = []
-    for det in detections_data.get("detections", []):
-        polygon_coords = pixel_polygon_to_lonlat_polygon(det["polygon_pixel"], image_size, bbox)
-        features.append({
-            "type": "Feature",
-            "properties": {
-                "class": det["class_name"],
-                "confidence": det["confidence"],
-                "parking": parking_name,
-                "tile_id": tile_id,
-            },
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": polygon_coords,
-            }
-        })
+        for line in f:
+            record = orjson.loads(line)
+            detections[record["tile_id"]] = record.get("detections", [])
 
-    return {
-        "tile_id": tile_id,
-        "features": features,
-    }
+    return detections
 
 
 def process_all_tiles() -> dict:
-    """Process all tiles for a parking and create GeoJSON files."""
+    """Process all tiles for a parking and create GeoJSON files.
+
+    Tiles are converted inline unless MAX_WORKERS and the tile count justify worker processes: a pool is only
+    started with at least MIN_TILES_PER_WORKER ready tiles for each of two or more workers.
+    """
     tiles_json_path = settings.tiles_dir / "tiles.json"
 
     if not tiles_json_path.exists():
         raise FileNotFoundError(f"tiles.json not found: {tiles_json_path}")
 
-    with open(tiles_json_path, "rb") as f:
-        tiles = orjson.loads(f.read())
+    tiles = load_json(tiles_json_path)
 
     parking_name = tiles[0]["parking"] if tiles else "unknown"
     logger.info(f"Converting detections for parking: [bold]{parking_name}[/]")
     logger.info(f"Total tiles: [bold]{len(tiles)}[/]")
 
+    detections_path = settings.detections_dir / f"{parking_name}_detections.ndjson"
+
+    if not detections_path.exists():
+        raise FileNotFoundError(f"Detections not found: {detections_path}")
+
+    detections = load_detections(detections_path)
+
     settings.output_dir.mkdir(parents=True, exist_ok=True)
 
-    all_features = []
+    ready_tiles = []
+    for tile in tiles:
+        if tile["tile_id"] not in detections:
+            logger.debug(f"No detections for tile {tile['tile_id']}, skipping")
+        else:
+            ready_tiles.append(tile)
+
     processed_count = 0
     total_vehicles = 0
 
-    for tile in tiles:
-        tile_id = tile["tile_id"]
-        result = convert_tile_detections(tile_id, parking_name)
-
-        if result is None:
-            continue
+    # One NDJSON shard per parking lets the aggregator copy all of its features in a single read
+    shard_path = settings.output_dir / f"{parking_name}_features.ndjson"
 
-        features = result["features"]
-        all_features.extend(features)
-        total_vehicles += len(features)
-        processed_count += 1
+    # Small parkings are converted inline: a worker process costs more to start than the tiles it would convert
+    workers = min(settings.max_workers, len(ready_tiles) // MIN_TILES_PER_WORKER)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext()
 
-        # Save individual tile GeoJSON
-        tile_name = f"{parking_name}_{tile_id}"
-        geojson = {
-            "type": "FeatureCollection",
-            "properties": {
-                "parking": parking_name,
-                "tile_id": tile_id,
-                "total_vehicles": len(features),
-                "crs": "EPSG:4326",
-            },
-            "features": features,
-        }
+    # Workers write their own GeoJSON and return features as a single bytes blob, which pickles as one copy
+    with pool as executor, open(shard_path, "wb") as shard:
+        convert_map = executor.map if executor is not None else map
+        results = convert_map(convert_and_save_tile, ready_tiles, [detections[tile["tile_id"]] for tile in ready_tiles])
 
-        output_path = settings.output_dir / f"{tile_name}_vehicles.geojson"
-        with open(output_path, "wb") as f:
-            f.write(orjson.dumps(geojson, option=orjson.OPT_INDENT_2))
+        for tile, (vehicles, lines) in zip(ready_tiles, results):
+            shard.write(lines)
+            total_vehicles += vehicles
+            processed_count += 1
 
-        logger.debug(f"  Tile {tile_id}: {len(features)} vehicles")
+            logger.debug(f"  Tile {tile['tile_id']}: {vehicles} vehicles")
 
     logger.info(f"Processed [bold]{processed_count}[/] tiles, total vehicles: [bold]{total_vehicles}[/]")
 
@@ -153,6 +226,8 @@ def process_all_tiles() -> dict:
 
 
 def main():
+    configure_logging(settings.log_level, settings.logging_plain)
+
     if not settings.tiles_dir.exists():
         logger.error(f"Tiles directory not found: {settings.tiles_dir}")
         sys.exit(1)
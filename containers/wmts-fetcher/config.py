@@ -1,13 +1,14 @@
 """Configuration for WMTS Fetcher."""
 
 import logging.config
+import re
+import sys
 from pathlib import Path
 from typing import Annotated, Any, Literal
-from pydantic import field_validator
+from pydantic import Field, field_validator
 
 import orjson
 from pydantic_settings import BaseSettings, NoDecode
-from rich.console import Console
 
 
 
@@ -30,7 +31,13 @@ class Settings(BaseSettings):
     zoom: int | None = None
     min_pixels: int = 1024
     http_timeout: float = 30.0
+    connect_timeout: float = 5.0
+    max_concurrency: int = Field(default=8, ge=1)
+    max_retries: int = Field(default=5, ge=1)
+    backoff_base: float = 0.5
+    preserve_source_bytes: bool = True
     log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "DEBUG"
+    logging_plain: bool = False
     wmts: WMTSConfig = WMTSConfig()
 
     @field_validator("parking_json", mode="before")
@@ -50,7 +57,39 @@ class Settings(BaseSettings):
         return self.parking_json["bbox"]
 
 
-def configure_logging(log_level: str = "INFO") -> None:
+class PlainFormatter(logging.Formatter):
+    """Formatter for plain log lines that drops the Rich markup tags ([bold], [/], ...) used in messages."""
+
+    markup = re.compile(r"\[(?:/|/?[a-z][a-z_ ]*)\]")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return self.markup.sub("", super().formatMessage(record))
+
+
+def configure_logging(log_level: str = "INFO", plain: bool = False) -> None:
+    """Configure logging; called from main() so importing the module stays cheap.
+
+    Rich is only used on an interactive terminal: pod logs are scraped as plain text, so there it would only add
+    import time and per-record rendering.
+    """
+    if plain or not sys.stderr.isatty():
+        # Plain stderr lines: skips importing Rich and rendering markup on every record
+        handler = {
+            "formatter": "plain",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stderr",
+        }
+    else:
+        from rich.console import Console
+
+        handler = {
+            "formatter": "default",
+            "class": "rich.logging.RichHandler",
+            "console": Console(stderr=True),
+            "omit_repeated_times": False,
+            "markup": True,
+        }
+
     logging.config.dictConfig({
         "version": 1,
         "disable_existing_loggers": False,
@@ -59,15 +98,14 @@ def configure_logging(log_level: str = "INFO") -> None:
                 "format": "[dark_cyan]%(name)s[/] %(message)s",
                 "datefmt": "%Y-%m-%d %H:%M:%S",
             },
+            "plain": {
+                "()": PlainFormatter,
+                "format": "%(asctime)s %(levelname)s %(name)s %(message)s",
+                "datefmt": "%Y-%m-%d %H:%M:%S",
+            },
         },
         "handlers": {
-            "default": {
-                "formatter": "default",
-                "class": "rich.logging.RichHandler",
-                "console": Console(stderr=True),
-                "omit_repeated_times": False,
-                "markup": True,
-            },
+            "default": handler,
         },
         "loggers": {
             "root": {"handlers": ["default"], "level": log_level},
@@ -77,4 +115,3 @@ def configure_logging(log_level: str = "INFO") -> None:
 
 
 settings = Settings()
-configure_logging(settings.log_level)
@@ -1,36 +1,51 @@
 #!/usr/bin/env python3
 """WMTS Fetcher - Downloads orthophoto tiles from Geoportal Poland WMTS service."""
 
+import asyncio
 import logging
+import random
+import struct
 import sys
 from io import BytesIO
+from pathlib import Path
 
 import httpx
 import orjson
-from PIL import Image
+from PIL import Image, features
 
-from config import settings
+from config import configure_logging, settings
 
 logger = logging.getLogger(__name__)
 
 # EPSG:3857 Web Mercator origin (half of world extent in meters)
 ORIGIN = 20037508.342787
 
+# Highest zoom level served by the orthophoto WMTS
+MAX_ZOOM = 19
+
+# Tile edge length in meters for every zoom level, instead of recomputing 2 * ORIGIN / 2**zoom per call
+_TILE_SIZE_M = tuple(2 * ORIGIN / (1 << zoom) for zoom in range(32))
+
+# Identifies the fetcher in the WMTS server logs
+HTTP_HEADERS = {"User-Agent": "parking-detection-wmts-fetcher"}
+
+# JPEG start-of-frame markers, which carry the image size (C4, C8 and CC are other segments)
+_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF})
+
+# Read size when streaming tile bodies to disk
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def meters_to_tile(x: float, y: float, zoom: int) -> tuple[int, int]:
     """Convert EPSG:3857 coordinates (meters) to tile x/y."""
-    tile_size_meters = 2 * ORIGIN / (2 ** zoom)
-    tile_x = int((x + ORIGIN) / tile_size_meters)
-    tile_y = int((ORIGIN - y) / tile_size_meters)
-    return tile_x, tile_y
+    tile_size_meters = _TILE_SIZE_M[zoom]
+    return int((x + ORIGIN) / tile_size_meters), int((ORIGIN - y) / tile_size_meters)
 
 
 def tile_to_meters(tile_x: int, tile_y: int, zoom: int) -> tuple[float, float]:
     """Convert tile x/y to EPSG:3857 coordinates (NW corner)."""
-    tile_size_meters = 2 * ORIGIN / (2 ** zoom)
-    x = tile_x * tile_size_meters - ORIGIN
-    y = ORIGIN - tile_y * tile_size_meters
-    return x, y
+    tile_size_meters = _TILE_SIZE_M[zoom]
+    return tile_x * tile_size_meters - ORIGIN, ORIGIN - tile_y * tile_size_meters
 
 
 def bbox_to_tiles(bbox: list[float], zoom: int) -> tuple[range, range]:
@@ -48,19 +63,29 @@ def bbox_to_tiles(bbox: list[float], zoom: int) -> tuple[range, range]:
     return range(min_row, max_row + 1), range(min_col, max_col + 1)
 
 
-def get_tile_bbox(row: int, col: int, zoom: int) -> list[float]:
-    """Get bbox [min_x, min_y, max_x, max_y] in EPSG:3857 for a tile."""
-    # NW corner
-    nw_x, nw_y = tile_to_meters(col, row, zoom)
-    # SE corner (NW of next tile diagonally)
-    se_x, se_y = tile_to_meters(col + 1, row + 1, zoom)
+def tile_edges(row_range: range, col_range: range, zoom: int) -> tuple[list[float], list[float]]:
+    """EPSG:3857 edges of a tile grid: row edges (y, north to south) and column edges (x, west to east).
+
+    Neighbouring tiles share edges, so the bbox of every tile in the grid comes from these N+1 and M+1 values
+    instead of two corner computations per tile.
+    """
+    row_edges = [tile_to_meters(0, row, zoom)[1] for row in range(row_range.start, row_range.stop + 1)]
+    col_edges = [tile_to_meters(col, 0, zoom)[0] for col in range(col_range.start, col_range.stop + 1)]
+    return row_edges, col_edges
 
-    return [nw_x, se_y, se_x, nw_y]  # [min_x, min_y, max_x, max_y]
 
+def retry_after(response: httpx.Response) -> float:
+    """Seconds to wait from a Retry-After header, 0 if it is missing or not given in seconds."""
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        return 0.0
 
-def fetch_tile(row: int, col: int, zoom: int, client: httpx.Client) -> Image.Image | None:
+
+def get_tile_params(zoom: int) -> dict[str, str]:
+    """WMTS GetTile query parameters shared by every tile at a zoom level."""
     wmts = settings.wmts
-    params = {
+    return {
         "SERVICE": "WMTS",
         "REQUEST": "GetTile",
         "VERSION": "1.0.0",
@@ -69,40 +94,170 @@ def fetch_tile(row: int, col: int, zoom: int, client: httpx.Client) -> Image.Ima
         "FORMAT": wmts.format,
         "TILEMATRIXSET": wmts.tile_matrix_set,
         "TILEMATRIX": f"{wmts.tile_matrix_set}:{zoom}",
-        "TILEROW": str(row),
-        "TILECOL": str(col),
     }
 
-    try:
-        response = client.get(wmts.base_url, params=params, timeout=settings.http_timeout)
-        response.raise_for_status()
 
-        if "image" not in response.headers.get("content-type", ""):
-            logger.error(f"WMTS error for tile ({row}, {col}): {response.text[:300]}")
+async def fetch_tile(
+    row: int, col: int, tile_params: dict[str, str], image_path: Path,
+    client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+) -> list[int] | None:
+    """Fetch a tile into image_path and return its [width, height], or None if it could not be fetched."""
+    params = {**tile_params, "TILEROW": str(row), "TILECOL": str(col)}
+
+    for attempt in range(settings.max_retries):
+        delay = settings.backoff_base * 2 ** attempt
+
+        try:
+            async with semaphore, client.stream("GET", settings.wmts.base_url, params=params) as response:
+                response.raise_for_status()
+
+                if "image" not in response.headers.get("content-type", ""):
+                    await response.aread()
+                    logger.error(f"WMTS error for tile ({row}, {col}): {response.text[:300]}")
+                    return None
+
+                if is_pass_through(response):
+                    return await stream_tile_to_file(response, image_path)
+
+                tile_bytes = await response.aread()
+
+            # CPU-bound re-encode runs in a worker thread (Pillow releases the GIL), after the connection slot is freed
+            return await asyncio.to_thread(reencode_tile, tile_bytes, image_path)
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            # Other 4xx responses are permanent, retrying will not change them
+            if status < 500 and status != 429:
+                logger.error(f"Error fetching tile ({row}, {col}): {e}")
+                return None
+            if status in (429, 503):
+                delay = max(retry_after(e.response), delay)
+            error = e
+        except httpx.TransportError as e:
+            # Timeouts and connection errors: jitter so throttled requests do not come back in lockstep
+            delay += random.uniform(0, settings.backoff_base)
+            error = e
+        except Exception as e:
+            logger.error(f"Error fetching tile ({row}, {col}): {e}")
             return None
 
-        return Image.open(BytesIO(response.content))
-    except Exception as e:
-        logger.error(f"Error fetching tile ({row}, {col}): {e}")
+        if attempt + 1 < settings.max_retries:
+            logger.debug(f"Retrying tile ({row}, {col}) in {delay:.1f}s ({attempt + 1}/{settings.max_retries}): {error}")
+            await asyncio.sleep(delay)
+
+    logger.error(f"Error fetching tile ({row}, {col}) after {settings.max_retries} attempts: {error}")
+    return None
+
+
+def is_pass_through(response: httpx.Response) -> bool:
+    """Whether a tile response can be saved byte for byte.
+
+    JPEG responses are kept as sent unless preserve_source_bytes is off: decoding and re-encoding them would only
+    cost CPU and quality. Other formats are decoded and saved as JPEG.
+    """
+    content_type = response.headers.get("content-type", "").split(";")[0].strip()
+    return settings.preserve_source_bytes and content_type == "image/jpeg" and settings.wmts.format == "image/jpeg"
+
+
+def jpeg_size(data: bytes) -> list[int] | None:
+    """Read [width, height] from the SOFn segment of a JPEG header, None if it is not within data."""
+    if not data.startswith(b"\xff\xd8"):
         return None
 
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+
+        if marker == 0xFF:  # fill byte
+            offset += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:  # standalone markers, no length
+            offset += 2
+        elif marker in _SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return [width, height]
+        else:
+            (length,) = struct.unpack_from(">H", data, offset + 2)
+            offset += 2 + length
+
+    return None
+
+
+async def stream_tile_to_file(response: httpx.Response, image_path: Path) -> list[int]:
+    """Stream a pass-through tile response to disk and return its [width, height]."""
+    header = None
+
+    # Chunks go straight from the socket to the file, the body is never held in memory as a whole
+    with open(image_path, "wb") as f:
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            if header is None:
+                header = chunk
+            f.write(chunk)
+
+    # Every tile of the WMTS tile matrix set should have the fixed tile size; the frame header in the first chunk
+    # confirms it without PIL or a decoder ever touching the pass-through tile
+    tile_size = [settings.wmts.tile_size, settings.wmts.tile_size]
+    image_size = jpeg_size(header or b"")
+
+    if image_size is None:
+        return tile_size
+    if image_size != tile_size:
+        logger.warning(f"Tile {image_path.name} is {image_size[0]}x{image_size[1]}, expected {tile_size[0]}x{tile_size[1]}")
+    return image_size
+
+
+def reencode_tile(tile_bytes: bytes, image_path: Path) -> list[int]:
+    """Decode a tile image, save it as JPEG and return its [width, height]."""
+    with Image.open(BytesIO(tile_bytes)) as tile_img:
+        # Anything JPEG cannot store, such as PNG alpha or palettes, is converted once
+        rgb_img = tile_img if tile_img.mode in ("RGB", "L") else tile_img.convert("RGB")
+        rgb_img.save(image_path, "JPEG", quality=95)
+        return [tile_img.width, tile_img.height]
+
 
 def select_zoom_level(bbox: list[float]) -> int:
-    """Select zoom level that provides at least min_pixels for the bbox."""
-    min_x, min_y, max_x, max_y = bbox
+    """Select the zoom level for the bbox.
 
-    for zoom in range(19, -1, -1):
-        sw_tile_x, sw_tile_y = meters_to_tile(min_x, min_y, zoom)
-        ne_tile_x, ne_tile_y = meters_to_tile(max_x, max_y, zoom)
+    A bbox never spans fewer tiles at a higher zoom, so MAX_ZOOM always gives the most pixels and is what the
+    previous per-zoom search always returned; only its coverage is checked, to warn when it is below min_pixels.
+    """
+    row_range, col_range = bbox_to_tiles(bbox, MAX_ZOOM)
+    pixels = min(len(row_range), len(col_range)) * settings.wmts.tile_size
 
-        tiles_x = abs(ne_tile_x - sw_tile_x) + 1
-        tiles_y = abs(ne_tile_y - sw_tile_y) + 1
+    if pixels < settings.min_pixels:
+        logger.warning(f"BBOX covers only {pixels}px at max zoom {MAX_ZOOM}, below MIN_PIXELS={settings.min_pixels}")
 
-        pixels = min(tiles_x, tiles_y) * settings.wmts.tile_size
-        if pixels >= settings.min_pixels:
-            return zoom
+    return MAX_ZOOM
 
-    return 19
+
+async def fetch_tiles(tiles: list[tuple[int, int, Path]], zoom: int) -> list[list[int] | None]:
+    """Fetch (row, col, image_path) tiles concurrently through one pooled client, at most max_concurrency in flight.
+
+    Image sizes (None for failed tiles) are returned in the order of tiles.
+    """
+    semaphore = asyncio.Semaphore(settings.max_concurrency)
+    limits = httpx.Limits(
+        max_connections=settings.max_concurrency,
+        max_keepalive_connections=settings.max_concurrency,
+        keepalive_expiry=60.0,
+    )
+    timeout = httpx.Timeout(settings.http_timeout, connect=settings.connect_timeout)
+    # Everything but the tile row/col is the same for all requests, so it is resolved once here
+    tile_params = get_tile_params(zoom)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, headers=HTTP_HEADERS, http2=True) as client:
+        # Pay DNS, TCP and TLS once up front so the fan-out multiplexes over a warm HTTP/2 connection
+        # instead of every first request racing to open its own
+        try:
+            await client.head(settings.wmts.base_url)
+        except httpx.HTTPError as e:
+            logger.debug(f"Connection warm-up failed: {e}")
+
+        return await asyncio.gather(*[
+            fetch_tile(row, col, tile_params, image_path, client, semaphore) for row, col, image_path in tiles
+        ])
 
 
 def fetch_orthophoto_tiles() -> dict:
@@ -123,59 +278,53 @@ def fetch_orthophoto_tiles() -> dict:
     tiles_list = []
     fetched_count = 0
 
-    with httpx.Client() as client:
-        for row_idx, row in enumerate(row_range):
-            for col_idx, col in enumerate(col_range):
-                tile_id = f"{row_idx}_{col_idx}"
-                logger.debug(f"Fetching tile ({row}, {col}) -> {tile_id}")
-
-                tile_img = fetch_tile(row, col, zoom, client)
-                if tile_img is None:
-                    logger.warning(f"Failed to fetch tile ({row}, {col}), skipping")
-                    continue
-
-                # Save tile image
-                tile_image_path = parking_dir / f"tile_{tile_id}.jpg"
-                tile_img.save(tile_image_path, "JPEG", quality=95)
-
-                # Get tile bbox
-                tile_bbox = get_tile_bbox(row, col, zoom)
-
-                # Save tile metadata
-                tile_meta = {
-                    "parking": settings.parking_name,
-                    "tile_id": tile_id,
-                    "tile_row": row,
-                    "tile_col": col,
-                    "bbox": tile_bbox,
-                    "image_size": [tile_img.width, tile_img.height],
-                    "crs": "EPSG:3857",
-                    "zoom_level": zoom,
-                }
-
-                tile_meta_path = parking_dir / f"tile_{tile_id}_meta.json"
-                with open(tile_meta_path, "wb") as f:
-                    f.write(orjson.dumps(tile_meta, option=orjson.OPT_INDENT_2))
-
-                # Add to tiles list for Argo fanout
-                tiles_list.append({
-                    "tile_id": tile_id,
-                    "parking": settings.parking_name,
-                    "image_path": str(tile_image_path.relative_to(settings.output_dir.parent)),
-                    "meta_path": str(tile_meta_path.relative_to(settings.output_dir.parent)),
-                })
-
-                fetched_count += 1
+    # The download is latency bound, so all requests go out together; metadata is collected afterwards in tile order
+    tiles = [
+        (row, col, parking_dir / f"tile_{row_idx}_{col_idx}.jpg")
+        for row_idx, row in enumerate(row_range)
+        for col_idx, col in enumerate(col_range)
+    ]
+    image_sizes = iter(asyncio.run(fetch_tiles(tiles, zoom)))
+    row_edges, col_edges = tile_edges(row_range, col_range, zoom)
+
+    for row_idx, row in enumerate(row_range):
+        for col_idx, col in enumerate(col_range):
+            tile_id = f"{row_idx}_{col_idx}"
+            logger.debug(f"Fetched tile ({row}, {col}) -> {tile_id}")
+
+            image_size = next(image_sizes)
+            if image_size is None:
+                logger.warning(f"Failed to fetch tile ({row}, {col}), skipping")
+                continue
+
+            tile_image_path = parking_dir / f"tile_{tile_id}.jpg"
+
+            # [min_x, min_y, max_x, max_y]: west/south/east/north edges of the tile
+            tile_bbox = [col_edges[col_idx], row_edges[row_idx + 1], col_edges[col_idx + 1], row_edges[row_idx]]
+
+            # Tile metadata lives only in tiles.json, which downstream steps read once instead of a file per tile
+            tiles_list.append({
+                "tile_id": tile_id,
+                "parking": settings.parking_name,
+                "image_path": str(tile_image_path.relative_to(settings.output_dir.parent)),
+                "tile_row": row,
+                "tile_col": col,
+                "bbox": tile_bbox,
+                "image_size": image_size,
+                "crs": "EPSG:3857",
+                "zoom_level": zoom,
+            })
+
+            fetched_count += 1
 
     if not tiles_list:
         raise RuntimeError("No tiles were fetched successfully")
 
     logger.info(f"Fetched [bold]{fetched_count}/{total_tiles}[/] tiles")
 
-    # Save tiles list for Argo workflow fanout
+    # Save tiles list for Argo workflow fanout; only machines read it, so it is written compact
     tiles_json_path = parking_dir / "tiles.json"
-    with open(tiles_json_path, "wb") as f:
-        f.write(orjson.dumps(tiles_list, option=orjson.OPT_INDENT_2))
+    tiles_json_path.write_bytes(orjson.dumps(tiles_list))
     logger.info(f"Saved tiles list: {tiles_json_path}")
 
     # Return summary metadata
@@ -192,6 +341,12 @@ def fetch_orthophoto_tiles() -> dict:
 
 
 def main():
+    configure_logging(settings.log_level, settings.logging_plain)
+
+    # PyPI Pillow wheels bundle libjpeg-turbo; a source build against plain libjpeg makes the re-encode fallback ~2x slower
+    if not features.check_feature("libjpeg_turbo"):
+        logger.warning("Pillow is not built with libjpeg-turbo, JPEG encoding will be slow")
+
     try:
         result = fetch_orthophoto_tiles()
         logger.info(f"[bold green]Success![/] Fetched {result['total_tiles']} tiles")
@@ -1,11 +1,13 @@
 """Configuration for YOLO Inference."""
 
 import logging.config
+import os
+import re
+import sys
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Literal
 
-from pydantic_settings import BaseSettings
-from rich.console import Console
+import orjson
 
 
 VEHICLE_CLASSES: dict[int, str] = {
@@ -13,20 +15,140 @@ VEHICLE_CLASSES: dict[int, str] = {
     10: "small-vehicle",
 }
 
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
 
-class Settings(BaseSettings):
-    """Settings for YOLO inference - processes all tiles for a parking."""
+# Export formats Ultralytics can quantize to INT8
+INT8_EXPORT_FORMATS = ("engine", "openvino")
 
-    tiles_dir: Path = Path("/data/output/parking")
-    model_path: Path = Path("/model/yolo26m-obb.pt")
-    output_dir: Path = Path("/data/output")
-    confidence_threshold: float = 0.25
-    save_annotated: bool = True
-    log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "INFO"
-    vehicle_classes: dict[int, str] = VEHICLE_CLASSES
+# Ultralytics export formats, mapped to the suffix the export adds to the checkpoint name
+EXPORT_SUFFIXES: dict[str, str] = {
+    "engine": ".engine",
+    "onnx": ".onnx",
+    "openvino": "_openvino_model",
+    "torchscript": ".torchscript",
+}
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Read a boolean environment variable, accepting the same spellings as pydantic."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if value.lower() in ("1", "true", "t", "yes", "y", "on"):
+        return True
+    if value.lower() in ("0", "false", "f", "no", "n", "off"):
+        return False
+    raise ValueError(f"{name} must be a boolean, got {value!r}")
+
+
+def _env_tiles_dirs() -> tuple[Path, ...]:
+    """Read TILES_DIR, one parking's tiles directory or several separated by os.pathsep."""
+    value = os.getenv("TILES_DIR", "/data/output/parking")
+    return tuple(Path(path) for path in value.split(os.pathsep) if path)
+
+
+def _env_vehicle_classes() -> dict[int, str]:
+    """Read VEHICLE_CLASSES as a JSON object of class id -> name, defaulting to VEHICLE_CLASSES."""
+    value = os.getenv("VEHICLE_CLASSES")
+    if value is None:
+        return dict(VEHICLE_CLASSES)
+    return {int(class_id): name for class_id, name in orjson.loads(value).items()}
+
+
+def _env_export_format() -> str | None:
+    """Read EXPORT_FORMAT, unset or empty meaning the checkpoint is used as is."""
+    export_format = os.getenv("EXPORT_FORMAT") or None
+    if export_format is not None and export_format not in EXPORT_SUFFIXES:
+        raise ValueError(f"EXPORT_FORMAT must be one of {', '.join(EXPORT_SUFFIXES)}, got {export_format!r}")
+    return export_format
+
+
+def _env_log_level() -> str:
+    """Read LOG_LEVEL, case-insensitively, defaulting to INFO."""
+    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if log_level not in LOG_LEVELS:
+        raise ValueError(f"LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}, got {log_level!r}")
+    return log_level
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Settings for YOLO inference - processes all tiles for a parking.
+
+    A plain dataclass read from environment variables: every inference pod pays the import cost at startup,
+    and pydantic-settings alone takes longer to import than this whole module.
+    """
 
+    tiles_dirs: tuple[Path, ...] = field(default_factory=_env_tiles_dirs)
+    model_path: Path = field(default_factory=lambda: Path(os.getenv("MODEL_PATH", "/model/yolo26m-obb.pt")))
+    output_dir: Path = field(default_factory=lambda: Path(os.getenv("OUTPUT_DIR", "/data/output")))
+    confidence_threshold: float = field(default_factory=lambda: float(os.getenv("CONFIDENCE_THRESHOLD", "0.25")))
+    half: bool = field(default_factory=lambda: _env_bool("HALF", True))
+    batch_size: int = field(default_factory=lambda: int(os.getenv("BATCH_SIZE", "8")))
+    batch_timeout: float = field(default_factory=lambda: float(os.getenv("BATCH_TIMEOUT", "0.05")))
+    decode_workers: int = field(default_factory=lambda: int(os.getenv("DECODE_WORKERS", "4")))
+    inference_workers: int = field(default_factory=lambda: int(os.getenv("INFERENCE_WORKERS", "1")))
+    export_format: str | None = field(default_factory=_env_export_format)
+    int8: bool = field(default_factory=lambda: _env_bool("INT8", False))
+    calibration_data: str | None = field(default_factory=lambda: os.getenv("CALIBRATION_DATA") or None)
+    save_annotated: bool = field(default_factory=lambda: _env_bool("SAVE_ANNOTATED", True))
+    annotated_every: int = field(default_factory=lambda: int(os.getenv("ANNOTATED_EVERY", "1")))
+    annotated_quality: int = field(default_factory=lambda: int(os.getenv("ANNOTATED_QUALITY", "85")))
+    log_level: str = field(default_factory=_env_log_level)
+    logging_plain: bool = field(default_factory=lambda: _env_bool("LOGGING_PLAIN", False))
+    vehicle_classes: dict[int, str] = field(default_factory=_env_vehicle_classes)
+
+    def __post_init__(self) -> None:
+        if self.int8 and self.export_format not in INT8_EXPORT_FORMATS:
+            raise ValueError(f"INT8 needs EXPORT_FORMAT set to one of {', '.join(INT8_EXPORT_FORMATS)}")
+        # Caught here rather than mid-run: BATCH_SIZE=0 queues no decodes and waits on the empty queue forever
+        if self.batch_size < 1:
+            raise ValueError(f"BATCH_SIZE must be at least 1, got {self.batch_size}")
+        if self.batch_timeout < 0:
+            raise ValueError(f"BATCH_TIMEOUT must not be negative, got {self.batch_timeout}")
+        if self.decode_workers < 1:
+            raise ValueError(f"DECODE_WORKERS must be at least 1, got {self.decode_workers}")
+        if self.inference_workers < 1:
+            raise ValueError(f"INFERENCE_WORKERS must be at least 1, got {self.inference_workers}")
+        if self.annotated_every < 1:
+            raise ValueError(f"ANNOTATED_EVERY must be at least 1, got {self.annotated_every}")
+        if not 0 <= self.annotated_quality <= 100:
+            raise ValueError(f"ANNOTATED_QUALITY must be between 0 and 100, got {self.annotated_quality}")
+
+
+class PlainFormatter(logging.Formatter):
+    """Formatter for plain log lines that drops the Rich markup tags ([bold], [/], ...) used in messages."""
+
+    markup = re.compile(r"\[(?:/|/?[a-z][a-z_ ]*)\]")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        return self.markup.sub("", super().formatMessage(record))
+
+
+def configure_logging(log_level: str = "INFO", plain: bool = False) -> None:
+    """Configure logging; called from main() so importing the module stays cheap.
+
+    Rich is only used on an interactive terminal: pod logs are scraped as plain text, so there it would only add
+    import time and per-record rendering.
+    """
+    if plain or not sys.stderr.isatty():
+        # Plain stderr lines: skips importing Rich and rendering markup on every record
+        handler = {
+            "formatter": "plain",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stderr",
+        }
+    else:
+        from rich.console import Console
+
+        handler = {
+            "formatter": "default",
+            "class": "rich.logging.RichHandler",
+            "console": Console(stderr=True),
+            "omit_repeated_times": False,
+            "markup": True,
+        }
 
-def configure_logging(log_level: str = "INFO") -> None:
     logging.config.dictConfig({
         "version": 1,
         "disable_existing_loggers": False,
@@ -35,15 +157,14 @@ def configure_logging(log_level: str = "INFO") -> None:
                 "format": "[dark_cyan]%(name)s[/] %(message)s",
                 "datefmt": "%Y-%m-%d %H:%M:%S",
             },
+            "plain": {
+                "()": PlainFormatter,
+                "format": "%(asctime)s %(levelname)s %(name)s %(message)s",
+                "datefmt": "%Y-%m-%d %H:%M:%S",
+            },
         },
         "handlers": {
-            "default": {
-                "formatter": "default",
-                "class": "rich.logging.RichHandler",
-                "console": Console(stderr=True),
-                "omit_repeated_times": False,
-                "markup": True,
-            },
+            "default": handler,
         },
         "loggers": {
             "root": {"handlers": ["default"], "level": log_level},
@@ -53,4 +174,3 @@ def configure_logging(log_level: str = "INFO") -> None:
 
 
 settings = Settings()
-configure_logging(settings.log_level)
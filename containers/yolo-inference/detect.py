@@ -2,70 +2,300 @@
 """YOLO Inference - Detects vehicles on all tiles for a parking."""
 
 import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
 import sys
-
+import tempfile
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from itertools import islice
+from pathlib import Path
+from typing import BinaryIO
+
+import cv2
+import numpy as np
 import orjson
-from PIL import Image
+import torch
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from ultralytics.utils.patches import imwrite
 
-from config import settings
+from config import EXPORT_SUFFIXES, configure_logging, settings
 
 logger = logging.getLogger(__name__)
 
+# Vehicle class ids as an array for the vectorized filter, and their names in a list indexed by class id
+VEHICLE_CLASS_IDS = np.fromiter(settings.vehicle_classes, dtype=np.int64)
+CLASS_NAMES = [settings.vehicle_classes.get(class_id) for class_id in range(max(settings.vehicle_classes, default=-1) + 1)]
 
-def detect_vehicles_on_tile(model: YOLO, image_path: str, tile_name: str) -> dict:
-    """Run detection on a single tile."""
-    logger.info(f"Processing tile: [bold]{tile_name}[/]")
-
-    results = model(image_path, conf=settings.confidence_threshold, verbose=False)
 
+def detect_vehicles_on_tile(result: Results, tile_name: str) -> dict:
+    """Collect vehicle detections from a single tile's inference result."""
     detections = []
+    class_counts = {}
+    obb = result.obb
+
+    if obb is not None and len(obb):
+        # A single device -> host copy of the tile's (N, 7) OBB tensor; classes, confidences and corners are all
+        # derived from it on the host, then filtered and rounded as NumPy arrays
+        obb = obb.cpu()
+        class_ids = obb.cls.numpy().astype(np.int64)
+        keep = np.isin(class_ids, VEHICLE_CLASS_IDS)
+        class_ids = class_ids[keep]
+        # float64 like the Python floats the per-detection .item() calls produced, so the rounding is unchanged
+        confidences = np.round(obb.conf.numpy()[keep].astype(np.float64), 4)
+        polygons = obb.xyxyxyxy.numpy()[keep].astype(np.float64)
+        centers = np.round(polygons.mean(axis=1), 2)
+        np.round(polygons, 2, out=polygons)
+
+        detections = [
+            {
+                "class_name": CLASS_NAMES[class_id],
+                "class_id": class_id,
+                "confidence": confidence,
+                "polygon_pixel": polygon,
+                "center_pixel": center,
+            }
+            for class_id, confidence, polygon, center in zip(
+                class_ids.tolist(), confidences.tolist(), polygons.tolist(), centers.tolist()
+            )
+        ]
+
+        # Counted on the class id array, with classes in order of first detection as before
+        unique_ids, first_index, counts = np.unique(class_ids, return_index=True, return_counts=True)
+        order = np.argsort(first_index)
+        for class_id, count in zip(unique_ids[order].tolist(), counts[order].tolist()):
+            class_counts[CLASS_NAMES[class_id]] = class_counts.get(CLASS_NAMES[class_id], 0) + count
+
+    logger.info(f"  {tile_name}: found [bold]{len(detections)}[/] vehicles")
 
-    for result in results:
-        obb = result.obb
-
-        if obb is None:
-            continue
+    return {
+        "tile": tile_name,
+        "total_vehicles": len(detections),
+        "class_counts": class_counts,
+        "detections": detections,
+    }
 
-        for i in range(len(obb)):
-            class_id = int(obb.cls[i].item())
 
-            if class_id not in settings.vehicle_classes:
+def save_annotated_tile(result: Results, tile_name: str) -> None:
+    """Render a tile's detections and write them as a JPEG, for a human to eyeball, not for the pipeline."""
+    annotated_path = settings.output_dir / f"{tile_name}_annotated.jpg"
+    # plot() returns BGR, which OpenCV's libjpeg-turbo encoder takes as is: no RGB copy, no PIL image
+    imwrite(annotated_path, result.plot(), [cv2.IMWRITE_JPEG_QUALITY, settings.annotated_quality])
+
+
+def load_model() -> YOLO:
+    """Load the detector, switching to an export in settings.export_format (e.g. a TensorRT engine) if one is set.
+
+    The export, optionally INT8-quantized, is written next to the checkpoint on first use and reused while it stays
+    there. With the checkpoint baked into the image every pod pays its build and calibration cost (minutes for a
+    TensorRT engine) at startup; to pay it once, put the checkpoint on a shared volume or point MODEL_PATH straight
+    at a prebuilt export. Pods exporting to a shared volume at the same time each build a private copy and publish
+    it atomically, so none loads another's half-written file.
+    """
+    if settings.export_format is None:
+        logger.info(f"Loading model from [bold]{settings.model_path}[/]")
+        return YOLO(str(settings.model_path))
+
+    checkpoint = YOLO(str(settings.model_path))
+    # Precision is part of the cached file name, so flipping INT8 or HALF never silently reuses an older export
+    precision = "-int8" if settings.int8 else "-fp16" if settings.half else ""
+    exported_path = settings.model_path.with_name(
+        f"{settings.model_path.stem}{precision}{EXPORT_SUFFIXES[settings.export_format]}"
+    )
+
+    if not exported_path.exists():
+        logger.info(f"Exporting [bold]{settings.model_path}[/] to {settings.export_format}{precision}, this runs once")
+        # INT8 calibration runs on the given dataset YAML, Ultralytics falls back to the task's sample dataset
+        calibration = {"data": settings.calibration_data} if settings.int8 and settings.calibration_data else {}
+        # Ultralytics writes next to the checkpoint under a fixed name, so export a private copy in a directory of
+        # our own on the same filesystem and publish the result with os.replace
+        with tempfile.TemporaryDirectory(prefix=".export-", dir=exported_path.parent) as export_dir:
+            private_checkpoint = YOLO(shutil.copy2(settings.model_path, export_dir))
+            # Dynamic batch axis up to batch_size, so the last, partial batch of tiles runs on the same export
+            output_path = private_checkpoint.export(
+                format=settings.export_format,
+                batch=settings.batch_size,
+                dynamic=True,
+                int8=settings.int8,
+                half=settings.half and not settings.int8,
+                verbose=False,
+                **calibration,
+            )
+            # FP32, FP16 and INT8 exports get the same name from Ultralytics, the precision suffix keeps them apart
+            try:
+                os.replace(output_path, exported_path)
+            except OSError:
+                # Directory exports (OpenVINO) cannot replace a non-empty directory another pod has just published
+                if not exported_path.exists():
+                    raise
+
+    logger.info(f"Loading model from [bold]{exported_path}[/]")
+    model = YOLO(str(exported_path), task="obb")
+    # Dynamic exports carry no input size, so keep predicting at the size the checkpoint was trained for
+    model.overrides["imgsz"] = checkpoint.overrides["imgsz"]
+    return model
+
+
+def read_tile(image_path: Path) -> np.ndarray | None:
+    """Decode a tile JPEG to BGR straight from a read-only memory map, None if it is empty or cannot be decoded.
+
+    Same decode as Ultralytics' imread for path sources, so predictions do not change, minus its copy of the file
+    into a NumPy buffer.
+    """
+    with open(image_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buffer = np.frombuffer(mm, dtype=np.uint8)
+            image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+            # The map cannot close while an array still views it
+            del buffer
+
+    return image
+
+
+def iter_tile_batches(tiles: list[tuple[str, Path]]) -> Iterator[list[tuple[str, np.ndarray | None]]]:
+    """Decode tile images in background threads and group them into batches of (tile_id, BGR image) as they finish.
+
+    A batch is handed over once batch_size tiles are decoded, or when no other tile finished within batch_timeout,
+    so inference never sits idle behind one slow decode waiting for a full batch; the dynamic export takes the
+    smaller batch as is. Up to two batches are decoded ahead (OpenCV releases the GIL while decoding), in whatever
+    order they complete. The image is None if the file could not be decoded.
+    """
+    decoded = queue.SimpleQueue()
+    pending_tiles = iter(tiles)
+    remaining = len(tiles)
+
+    with ThreadPoolExecutor(max_workers=settings.decode_workers) as executor:
+        def submit(count: int) -> None:
+            for tile_id, image_path in islice(pending_tiles, count):
+                future = executor.submit(read_tile, image_path)
+                future.add_done_callback(lambda future, tile_id=tile_id: decoded.put((tile_id, future)))
+
+        submit(2 * settings.batch_size)
+
+        while remaining:
+            batch = [decoded.get()]
+            while len(batch) < min(settings.batch_size, remaining):
+                try:
+                    batch.append(decoded.get(timeout=settings.batch_timeout))
+                except queue.Empty:
+                    break
+
+            remaining -= len(batch)
+            submit(len(batch))
+            yield [(tile_id, future.result()) for tile_id, future in batch]
+
+
+def detect_tiles(model: YOLO, parking_name: str, tiles: list[tuple[str, Path]], out: BinaryIO) -> list[int]:
+    """Run batched inference over (tile_id, image_path) pairs and write each tile's detections as an NDJSON line.
+
+    Returns only the vehicle count of each processed tile: detections go straight to out, and each tile's Results
+    (with its decoded image) is dropped as soon as it is written, or annotated if sampled for that.
+    """
+    vehicle_counts = []
+    # Tiles finish decoding in any order, so ANNOTATED_EVERY samples on the tile's position in the input instead
+    tile_indexes = {tile_id: index for index, (tile_id, _) in enumerate(tiles)}
+
+    # Annotated images are rendered and encoded off the detection loop, at most two batches behind it
+    with ThreadPoolExecutor(max_workers=1) as annotator:
+        annotating = deque()
+
+        for decoded in iter_tile_batches(tiles):
+            batch = []
+            for tile_id, image in decoded:
+                if image is None:
+                    logger.warning(f"Could not decode tile {tile_id}, skipping")
+                else:
+                    batch.append((tile_id, image))
+
+            if not batch:
                 continue
 
-            confidence = float(obb.conf[i].item())
-            polygon = obb.xyxyxyxy[i].tolist()
+            # One forward pass per batch of already decoded tiles; results come back in input order
+            results = model.predict(
+                [image for _, image in batch],
+                batch=settings.batch_size,
+                conf=settings.confidence_threshold,
+                # FP16 forward pass for the PyTorch checkpoint on GPU; Ultralytics keeps FP32 on CPU, and exports run
+                # at the precision they were built with
+                half=settings.half,
+                stream=True,
+                verbose=False,
+            )
 
-            center_x = sum(p[0] for p in polygon) / 4
-            center_y = sum(p[1] for p in polygon) / 4
+            # strict=True runs the stream to its end, so the predictor releases its lock and runs its end callbacks
+            for (tile_id, _), tile_result in zip(batch, results, strict=True):
+                tile_name = f"{parking_name}_{tile_id}"
+                result = detect_vehicles_on_tile(tile_result, tile_name)
 
-            detections.append({
-                "class_name": settings.vehicle_classes[class_id],
-                "class_id": class_id,
-                "confidence": round(confidence, 4),
-                "polygon_pixel": [[round(p[0], 2), round(p[1], 2)] for p in polygon],
-                "center_pixel": [round(center_x, 2), round(center_y, 2)],
-            })
+                out.write(orjson.dumps({
+                    "parking": parking_name,
+                    "tile_id": tile_id,
+                    "total_vehicles": result["total_vehicles"],
+                    "class_counts": result["class_counts"],
+                    "detections": result["detections"],
+                }, option=orjson.OPT_APPEND_NEWLINE))
 
-    logger.info(f"  Found [bold]{len(detections)}[/] vehicles")
+                if settings.save_annotated and tile_indexes[tile_id] % settings.annotated_every == 0:
+                    annotating.append(annotator.submit(save_annotated_tile, tile_result, tile_name))
+                    if len(annotating) > 2 * settings.batch_size:
+                        annotating.popleft().result()
 
-    # Save annotated image if enabled
-    if settings.save_annotated and results:
-        annotated_path = settings.output_dir / f"{tile_name}_annotated.jpg"
-        annotated_img = results[0].plot()
-        img = Image.fromarray(annotated_img[..., ::-1])
-        img.save(annotated_path, "JPEG", quality=95)
+                vehicle_counts.append(result["total_vehicles"])
+
+        # Surface any annotation error; leaving the block also waits for writes still in flight after a failure
+        while annotating:
+            annotating.popleft().result()
+
+    return vehicle_counts
 
-    return {
-        "tile": tile_name,
-        "total_vehicles": len(detections),
-        "detections": detections,
-    }
 
+_worker_model: YOLO | None = None
 
-def process_all_tiles() -> dict:
-    """Process all tiles for a parking from tiles.json."""
-    tiles_json_path = settings.tiles_dir / "tiles.json"
+
+def _init_worker() -> None:
+    """Load the model once per worker process, splitting the CPU threads between workers."""
+    global _worker_model
+    configure_logging(settings.log_level, settings.logging_plain)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // settings.inference_workers))
+    _worker_model = load_model()
+
+
+def _detect_shard(parking_name: str, tiles: list[tuple[str, Path]]) -> tuple[list[int], bytes]:
+    """Run a worker's shard of tiles on the model its initializer loaded, returning its NDJSON lines as one blob."""
+    buffer = BytesIO()
+    vehicle_counts = detect_tiles(_worker_model, parking_name, tiles, buffer)
+    return vehicle_counts, buffer.getvalue()
+
+
+def detect_tiles_in_workers(
+    executor: ProcessPoolExecutor, parking_name: str, tiles: list[tuple[str, Path]], out: BinaryIO,
+) -> list[int]:
+    """Split the tiles into contiguous shards, one per inference worker, each with its own model replica."""
+    workers = min(settings.inference_workers, len(tiles))
+    shards = [tiles[i * len(tiles) // workers:(i + 1) * len(tiles) // workers] for i in range(workers)]
+    futures = [executor.submit(_detect_shard, parking_name, shard) for shard in shards]
+
+    vehicle_counts = []
+    for future in futures:
+        shard_counts, lines = future.result()
+        out.write(lines)
+        vehicle_counts.extend(shard_counts)
+
+    return vehicle_counts
+
+
+def process_all_tiles(tiles_dir: Path, model: YOLO, executor: ProcessPoolExecutor | None) -> dict:
+    """Process all tiles for a parking from tiles.json, on the workers of executor if there is one."""
+    tiles_json_path = tiles_dir / "tiles.json"
 
     if not tiles_json_path.exists():
         raise FileNotFoundError(f"tiles.json not found: {tiles_json_path}")
@@ -77,70 +307,78 @@ def process_all_tiles() -> dict:
     logger.info(f"Processing parking: [bold]{parking_name}[/]")
     logger.info(f"Total tiles: [bold]{len(tiles)}[/]")
 
-    logger.info(f"Loading model from [bold]{settings.model_path}[/]")
-    model = YOLO(str(settings.model_path))
-
     settings.output_dir.mkdir(parents=True, exist_ok=True)
 
-    all_results = []
-    total_vehicles = 0
-
+    ready_tiles = []
     for tile in tiles:
-        tile_id = tile["tile_id"]
-        tile_name = f"{parking_name}_{tile_id}"
-        image_path = settings.tiles_dir / f"tile_{tile_id}.jpg"
+        image_path = tiles_dir / f"tile_{tile['tile_id']}.jpg"
 
         if not image_path.exists():
             logger.warning(f"Tile image not found: {image_path}, skipping")
             continue
 
-        result = detect_vehicles_on_tile(model, str(image_path), tile_name)
-        total_vehicles += result["total_vehicles"]
+        ready_tiles.append((tile["tile_id"], image_path))
 
-        # Save detections for this tile
-        detections_path = settings.output_dir / f"{tile_name}_detections.json"
-        with open(detections_path, "wb") as f:
-            f.write(orjson.dumps({
-                "parking": parking_name,
-                "tile_id": tile_id,
-                "total_vehicles": result["total_vehicles"],
-                "class_counts": _count_classes(result["detections"]),
-                "detections": result["detections"],
-            }, option=orjson.OPT_INDENT_2))
+    # One NDJSON line per tile for the whole parking instead of a pretty-printed JSON file per tile
+    detections_path = settings.output_dir / f"{parking_name}_detections.ndjson"
 
-        all_results.append(result)
+    with open(detections_path, "wb") as out:
+        if executor is not None and len(ready_tiles) > 1:
+            vehicle_counts = detect_tiles_in_workers(executor, parking_name, ready_tiles, out)
+        else:
+            vehicle_counts = detect_tiles(model, parking_name, ready_tiles, out)
+
+    total_vehicles = sum(vehicle_counts)
 
     logger.info(f"[bold green]Done![/] Total vehicles across all tiles: [bold]{total_vehicles}[/]")
 
     return {
         "parking": parking_name,
         "total_tiles": len(tiles),
-        "processed_tiles": len(all_results),
+        "processed_tiles": len(vehicle_counts),
         "total_vehicles": total_vehicles,
     }
 
 
-def _count_classes(detections: list[dict]) -> dict[str, int]:
-    """Count detections by class."""
-    counts = {}
-    for det in detections:
-        cls = det["class_name"]
-        counts[cls] = counts.get(cls, 0) + 1
-    return counts
+def process_all_parkings() -> list[dict]:
+    """Process every parking in settings.tiles_dirs on one resident model (and one set of inference workers).
+
+    Loading the model, building its export and the warm-up run on the first batch are paid once per process
+    instead of once per parking.
+    """
+    # Also done with inference workers: the export, if any, is built here once instead of racing in every worker
+    model = load_model()
+
+    if settings.inference_workers <= 1:
+        return [process_all_tiles(tiles_dir, model, None) for tiles_dir in settings.tiles_dirs]
+
+    # Spawned rather than forked, since CUDA cannot be used in a process forked after it was initialized
+    logger.info(f"Running inference in [bold]{settings.inference_workers}[/] worker processes")
+    with ProcessPoolExecutor(
+        max_workers=settings.inference_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    ) as executor:
+        return [process_all_tiles(tiles_dir, model, executor) for tiles_dir in settings.tiles_dirs]
 
 
 def main():
-    if not settings.tiles_dir.exists():
-        logger.error(f"Tiles directory not found: {settings.tiles_dir}")
-        sys.exit(1)
+    configure_logging(settings.log_level, settings.logging_plain)
+
+    for tiles_dir in settings.tiles_dirs:
+        if not tiles_dir.exists():
+            logger.error(f"Tiles directory not found: {tiles_dir}")
+            sys.exit(1)
 
     if not settings.model_path.exists():
         logger.error(f"Model not found: {settings.model_path}")
         sys.exit(1)
 
     try:
-        result = process_all_tiles()
-        logger.info(f"[bold green]Success![/] Processed {result['processed_tiles']} tiles, found {result['total_vehicles']} vehicles")
+        results = process_all_parkings()
+        processed_tiles = sum(result["processed_tiles"] for result in results)
+        total_vehicles = sum(result["total_vehicles"] for result in results)
+        logger.info(f"[bold green]Success![/] Processed {processed_tiles} tiles, found {total_vehicles} vehicles")
     except Exception as e:
         logger.exception(f"Error: {e}")
         sys.exit(1)
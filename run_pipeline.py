@@ -1,49 +1,102 @@
 #!/usr/bin/env python3
-"""Local pipeline runner - processes all tiles for a parking."""
+"""Local pipeline runner - processes all tiles for one or more parkings."""
 
+import importlib
+import json
 import os
-import subprocess
 import sys
+import threading
+import traceback
 from pathlib import Path
 
+CONTAINERS_DIR = Path(__file__).resolve().parent / "containers"
 
-def run_command(cmd: list[str], env: dict | None = None) -> bool:
-    """Run a command with optional environment variables."""
-    full_env = os.environ.copy()
-    if env:
-        full_env.update(env)
+# Heavy, config-independent imports of the inference stage, loaded while the I/O-bound fetch runs
+INFERENCE_MODULES = ("torch", "ultralytics", "ultralytics.engine.results")
 
-    result = subprocess.run(cmd, env=full_env)
-    return result.returncode == 0
+
+def run_stage(container: str, module_name: str, env: dict | None = None) -> bool:
+    """Run a container's script in this interpreter with optional environment variables.
+
+    Stages share the process, so torch, ultralytics, numpy and PIL are imported once for the whole pipeline
+    instead of once per stage. Every container ships its own module named config, which reads the environment
+    at import time, so the previous stage's config is dropped and the stage's environment applied before import.
+    """
+    stage_dir = str(CONTAINERS_DIR / container)
+    saved_env = os.environ.copy()
+    os.environ.update(env or {})
+    sys.modules.pop("config", None)
+    sys.modules.pop(module_name, None)
+    # Kept on sys.path while the stage runs, so worker processes it starts can import the same modules
+    sys.path.insert(0, stage_dir)
+
+    try:
+        importlib.import_module(module_name).main()
+    except SystemExit as e:
+        return e.code in (None, 0)
+    except Exception:
+        # Settings are validated at import, outside main()'s own error handling
+        traceback.print_exc()
+        return False
+    finally:
+        sys.path.remove(stage_dir)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+    return True
+
+
+def preload_modules(names: tuple[str, ...]) -> None:
+    """Import modules ahead of the stage that needs them; a failure is left for that stage to report."""
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            return
 
 
 def main():
     output_dir = Path(os.environ.get("OUTPUT_DIR", "./output"))
-    parking_name = os.environ.get("PARKING_NAME", "test")
     model_path = os.environ.get("MODEL_PATH", "./containers/yolo-inference/yolo26m-obb.pt")
 
-    tiles_dir = output_dir / parking_name
+    # PARKINGS_JSON takes a list of parkings, like the workflow's parkings parameter; without it the fetcher
+    # reads a single PARKING_JSON from the environment
+    if "PARKINGS_JSON" in os.environ:
+        parkings = [
+            (parking["name"], {"PARKING_JSON": json.dumps(parking), "OUTPUT_DIR": str(output_dir)})
+            for parking in json.loads(os.environ["PARKINGS_JSON"])
+        ]
+    else:
+        parkings = [(os.environ.get("PARKING_NAME", "test"), {})]
+
+    tiles_dirs = [str(output_dir / parking_name) for parking_name, _ in parkings]
+
+    # Step 1: Fetch tiles, importing torch and ultralytics for step 2 in the meantime (~2 s otherwise spent after it)
+    preload = threading.Thread(target=preload_modules, args=(INFERENCE_MODULES,), daemon=True)
+    preload.start()
 
-    # Step 1: Fetch tiles
     print(f"\n{'='*60}")
     print("STEP 1: Fetching WMTS tiles")
     print(f"{'='*60}")
-    if not run_command([sys.executable, "containers/wmts-fetcher/fetch_tiles.py"]):
-        print("ERROR: Failed to fetch tiles")
-        sys.exit(1)
+    for parking_name, env in parkings:
+        if not run_stage("wmts-fetcher", "fetch_tiles", env=env):
+            print(f"ERROR: Failed to fetch tiles for {parking_name}")
+            sys.exit(1)
 
-    # Step 2: Run YOLO inference on all tiles
+    # Step 2: Run YOLO inference on all tiles of all parkings, loading the model once
     print(f"\n{'='*60}")
     print("STEP 2: Running YOLO inference on all tiles")
     print(f"{'='*60}")
 
+    preload.join()
+
     env = {
-        "TILES_DIR": str(tiles_dir),
+        "TILES_DIR": os.pathsep.join(tiles_dirs),
         "MODEL_PATH": model_path,
         "OUTPUT_DIR": str(output_dir),
     }
 
-    if not run_command([sys.executable, "containers/yolo-inference/detect.py"], env=env):
+    if not run_stage("yolo-inference", "detect", env=env):
         print("ERROR: Failed to run YOLO inference")
         sys.exit(1)
 
@@ -52,15 +105,16 @@ def main():
     print("STEP 3: Converting detections to GeoJSON")
     print(f"{'='*60}")
 
-    env = {
-        "TILES_DIR": str(tiles_dir),
-        "DETECTIONS_DIR": str(output_dir),
-        "OUTPUT_DIR": str(output_dir),
-    }
+    for tiles_dir in tiles_dirs:
+        env = {
+            "TILES_DIR": tiles_dir,
+            "DETECTIONS_DIR": str(output_dir),
+            "OUTPUT_DIR": str(output_dir),
+        }
 
-    if not run_command([sys.executable, "containers/geo-converter/convert.py"], env=env):
-        print("ERROR: Failed to convert detections")
-        sys.exit(1)
+        if not run_stage("geo-converter", "convert", env=env):
+            print("ERROR: Failed to convert detections")
+            sys.exit(1)
 
     # Step 4: Aggregate results
     print(f"\n{'='*60}")
@@ -72,7 +126,7 @@ def main():
         "OUTPUT_DIR": str(output_dir),
     }
 
-    if not run_command([sys.executable, "containers/aggregator/aggregate.py"], env=env):
+    if not run_stage("aggregator", "aggregate", env=env):
         print("ERROR: Failed to aggregate results")
         sys.exit(1)
 